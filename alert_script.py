@@ -3,11 +3,23 @@ import pandas as pd
 import smtplib
 import os
 import json
+import re
+import argparse
+import calendar
 from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.charset import Charset, QP
 import logging
+from logging.handlers import MemoryHandler, RotatingFileHandler
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+try:
+    import orjson  # Optional: faster JSON, falls back to the stdlib json module
+except ImportError:
+    orjson = None
 import os
 import smtplib
 import logging
@@ -28,184 +40,575 @@ TICKERS = [
     'QQQ'                  # NASDAQ-100 ETF
 ]
 # Rest of the code remains exactly the same...
-EMA_DAYS = [20, 50, 100, 200]  # Key EMAs to track
+EMA_DAYS = (20, 50, 100, 200)  # Key EMAs to track
+EMA_ALPHAS = np.array([2.0 / (span + 1.0) for span in EMA_DAYS])  # Smoothing factor per span
+EMA_DECAYS = 1.0 - EMA_ALPHAS  # Weight kept by the previous EMA value
+EMA_ALPHAS.flags.writeable = False
+EMA_DECAYS.flags.writeable = False
+# Closes older than this carry < 1e-4 of the 200 EMA's weight, so EMAs only read this many
+EMA_MAX_WINDOW = 5 * max(EMA_DAYS)
+# Daily history fetched per ticker (~125 bars). This is already shorter than the
+# 200 EMA span and doubles as the volatility window, so it should not be cut further.
+HISTORY_PERIOD = '6mo'
 VOLATILITY_THRESHOLD = 2.5  # %
+TOUCH_THRESHOLD = 0.5  # % distance from an EMA that counts as "touching"
 LAST_BUY_FILE = 'last_buy_dates.json'
+MAX_FETCH_WORKERS = 8  # Parallel requests when retrying individual tickers
+# The price cache is a pickle, and unpickling runs code, so it must live somewhere only this
+# user can write. Set PRICE_CACHE_FILE to keep it outside a shared checkout.
+PRICE_CACHE_FILE = os.getenv('PRICE_CACHE_FILE', 'price_cache.pkl')
+PRICE_CACHE_TTL = timedelta(hours=float(os.getenv('PRICE_CACHE_TTL_HOURS', '6')))
 
 EMAIL_SENDER = os.getenv("EMAIL")
 EMAIL_PASSWORD = os.getenv("PASS")
 EMAIL_RECEIVERS = os.getenv('EMAIL_RECEIVER', '').split(',')
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 465
+
+# UTF-8 with quoted-printable bodies: the HTML is mostly ASCII, so this is
+# ~20% smaller on the wire than the base64 that MIMEText picks by default
+HTML_CHARSET = Charset('utf-8')
+HTML_CHARSET.body_encoding = QP
 
 # Setup logging
+# File output is buffered (flushed every LOG_BUFFER_RECORDS records, on errors,
+# and by logging's own exit hook) and rotated so the log cannot grow unbounded
+LOG_FILE = 'etf_accumulation.log'
+LOG_MAX_BYTES = 1_000_000
+LOG_BACKUP_COUNT = 3
+LOG_BUFFER_RECORDS = 100
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# The buffered records are written by the file handler, so it needs its own formatter
+log_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+log_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('etf_accumulation.log'),
+        MemoryHandler(LOG_BUFFER_RECORDS, target=log_file_handler),
         logging.StreamHandler()
     ]
 )
 
 def fetch_data(ticker, period, interval):
     try:
-        df = yf.download(ticker, period=period, interval=interval, auto_adjust=True, progress=False)
+        # Ticker.history is safe to call from worker threads, unlike yf.download
+        # which shares module-level result state between concurrent calls
+        df = yf.Ticker(ticker).history(period=period, interval=interval, auto_adjust=True)
         if df.empty:
             raise ValueError(f"No data returned for {ticker}")
-        return df
+        return naive_index(df)
     except Exception as e:
-        logging.error(f"Error fetching data for {ticker}: {str(e)}")
+        logging.error("Error fetching data for %s: %s", ticker, e)
         return pd.DataFrame()
 
-def safe_float_conversion(value):
-    """Safely convert any numeric value to float without warnings"""
-    if isinstance(value, (np.ndarray, pd.Series)):
-        if value.size == 0:
-            return 0.0
-        value = value.item()  # Convert numpy array to Python scalar
+def naive_index(df):
+    """
+    Drop the timezone from a frame's index, keeping exchange-local dates.
+    Ticker.history returns tz-aware bars while yf.download returns naive ones,
+    and cached frames from both must stay comparable.
+    """
+    if getattr(df.index, 'tz', None) is not None:
+        df.index = df.index.tz_localize(None)
+    return df
+
+def load_price_cache(key):
+    """
+    Return (data, age) from the price cache if it was saved for key, else (None, None).
+    The file is trusted: pd.read_pickle executes whatever it contains.
+    """
+    try:
+        if not os.path.exists(PRICE_CACHE_FILE):
+            return None, None
+        age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(PRICE_CACHE_FILE))
+        cached = pd.read_pickle(PRICE_CACHE_FILE)
+        if cached.get('key') != key:
+            return None, None
+        return cached['data'], age
+    except Exception as e:
+        logging.error("Error loading price cache: %s", e)
+        return None, None
+
+def save_price_cache(key, data):
     try:
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
+        pd.to_pickle({'key': key, 'data': data}, PRICE_CACHE_FILE)
+    except Exception as e:
+        logging.error("Error saving price cache: %s", e)
+
+def download_batch(tickers, **kwargs):
+    """One batched yf.download, split into non-empty per-ticker frames"""
+    try:
+        df_all = yf.download(
+            tickers, auto_adjust=True, progress=False, group_by='ticker', threads=True, **kwargs
+        )
+    except Exception as e:
+        logging.error("Error fetching batch data: %s", e)
+        return {}
 
-def calculate_percentage_diff(current, ma):
-    """Calculate percentage difference between current price and MA"""
-    if ma == 0:  # Avoid division by zero
-        return 0.0
-    return ((current - ma) / ma) * 100
+    data = {}
+    batch_tickers = set(df_all.columns.get_level_values(0))
+    for ticker in tickers:
+        if ticker in batch_tickers:
+            daily = df_all[ticker].dropna(how='all')
+            if not daily.empty:
+                data[ticker] = naive_index(daily)
+    return data
 
-def calculate_zone_score(ema_diffs):
+def update_cached_data(cached, saved_at, interval):
     """
-    Calculate accumulation zone score based on which EMAs the price is touching:
+    Bring cached per-ticker frames up to date by downloading only the bars
+    since the oldest last complete cached bar, keeping each ticker's window length.
+    Bars dated on or after the day the cache was saved may have been partial
+    (the job runs during NSE trading hours), so they are replaced, not kept.
+    A ticker is dropped (so it gets refetched in full) if its last complete bar
+    no longer matches, e.g. after a dividend changed the adjusted history.
+    """
+    saved_day = pd.Timestamp(saved_at.date())
+    complete = {}
+    for ticker, old in cached.items():
+        old = old[old.index < saved_day]
+        if not old.empty:
+            complete[ticker] = old
+    if not complete:
+        return {}
+
+    start = min(df.index.max() for df in complete.values())
+    recent = download_batch(list(complete), start=start, interval=interval)
+
+    data = {}
+    for ticker, old in complete.items():
+        new = recent.get(ticker)
+        if new is None:
+            continue
+        try:
+            last = old.index.max()
+            if last not in new.index or not np.isclose(new.at[last, 'Close'], old.at[last, 'Close']):
+                continue
+            window = cached[ticker].index.max() - old.index.min()
+            combined = pd.concat([old, new[new.index > last]])
+            data[ticker] = combined[combined.index >= combined.index.max() - window]
+        except Exception as e:
+            logging.warning("Could not update cached data for %s: %s", ticker, e)
+    return data
+
+def fetch_all(tickers, period, interval):
+    """Fetch data for all tickers in one batched request, keyed by ticker"""
+    cache_key = (tuple(tickers), period, interval)
+    cached, age = load_price_cache(cache_key)
+    if cached is not None and age <= PRICE_CACHE_TTL:
+        logging.info("Using cached price data from %s", PRICE_CACHE_FILE)
+        return cached
+
+    data = {}
+    if cached is not None:
+        # Stale cache: only fetch the bars that are new since it was written
+        try:
+            data = update_cached_data(cached, datetime.now() - age, interval)
+            logging.info("Updated cached price data for %d of %d tickers", len(data), len(tickers))
+        except Exception as e:
+            logging.warning("Could not update cached price data, refetching in full: %s", e)
+            data = {}
+
+    # Full history for anything not served from the cache
+    missing = [ticker for ticker in tickers if ticker not in data]
+    if missing:
+        data.update(download_batch(missing, period=period, interval=interval))
+    data = {ticker: data[ticker] for ticker in tickers if ticker in data}
+    missing = [ticker for ticker in tickers if ticker not in data]
+
+    # Fall back to individual requests for anything the batch did not return
+    if missing:
+        logging.warning("Batch download missed %s, retrying individually", ', '.join(missing))
+        with ThreadPoolExecutor(max_workers=min(MAX_FETCH_WORKERS, len(missing))) as executor:
+            fetched = executor.map(lambda ticker: fetch_data(ticker, period, interval), missing)
+            data.update(zip(missing, fetched))
+
+    # Only cache complete results so a failed ticker is retried on the next run
+    if all(not df.empty for df in data.values()):
+        save_price_cache(cache_key, data)
+    return data
+
+# Zone lookup table, indexed by zone_index() below:
+#   0-3:  touching the 20/50/100/200 EMA (highest EMA touched wins)
+#   4-7:  not touching, below the closest EMA
+#   8-11: not touching, above the closest EMA
+_ZONE_SCORES = np.array([60, 75, 90, 100, 40, 55, 70, 85, 0, 10, 20, 30])
+_ZONE_LABELS = [
+    "➖ Good Price (Touching 20 EMA)",
+    "👍 Great Price (Touching 50 EMA)",
+    "⭐ Excellent Price (Touching 100 EMA)",
+    "🐐 Goated Price (Touching 200 EMA)",
+    "Near Good Zone (Approaching 20 EMA)",
+    "Near Great Zone (Approaching 50 EMA)",
+    "Near Excellent Zone (Approaching 100 EMA)",
+    "Near Goated Zone (Approaching 200 EMA)",
+    "⛔ Very Expensive Zone (Above 20 EMA)",
+    "⛔ Expensive Zone (Above 50 EMA)",
+    "⚠️ High Zone (Above 100 EMA)",
+    "⚠️ Caution Zone (Above 200 EMA)",
+]
+
+def zone_index(ema_diffs):
+    """
+    Map a [tickers, 4] array of EMA percentage differences to indices into
+    the zone lookup table, for all tickers at once.
+    """
+    abs_diffs = np.abs(ema_diffs)
+    touching = abs_diffs <= TOUCH_THRESHOLD
+    rows = np.arange(len(ema_diffs))
+
+    # Highest EMA being touched
+    highest_touch = touching.shape[1] - 1 - np.argmax(touching[:, ::-1], axis=1)
+
+    # Otherwise, the closest EMA and which side of it we are on
+    closest = np.argmin(abs_diffs, axis=1)
+    below = ema_diffs[rows, closest] < 0
+
+    return np.where(
+        touching.any(axis=1),
+        highest_touch,
+        np.where(below, 4 + closest, 8 + closest)
+    )
+
+def calculate_zone_scores(ema_diffs):
+    """
+    Calculate accumulation zone scores based on which EMAs the price is touching:
     - Touching 20 EMA: Good (Score 60)
     - Touching 50 EMA: Great (Score 75)
     - Touching 100 EMA: Excellent (Score 90)
     - Touching 200 EMA: Goated (Score 100)
+    If not touching any EMA, the score is based on the closest EMA and whether
+    price is below it (40-85) or above it (0-30).
+    Returns (scores, labels) for every row of a [tickers, 4] array.
     """
-    # Tolerance for "touching" (percentage difference threshold)
-    TOUCH_THRESHOLD = 0.5  # %
-    
-    # Check which EMAs the price is touching (within threshold)
-    touching = [
-        abs(diff) <= TOUCH_THRESHOLD
-        for diff in ema_diffs
-    ]
-    
-    # Determine the highest EMA being touched
-    if touching[3]:  # 200 EMA
-        return 100, "🐐 Goated Price (Touching 200 EMA)"
-    elif touching[2]:  # 100 EMA
-        return 90, "⭐ Excellent Price (Touching 100 EMA)"
-    elif touching[1]:  # 50 EMA
-        return 75, "👍 Great Price (Touching 50 EMA)"
-    elif touching[0]:  # 20 EMA
-        return 60, "➖ Good Price (Touching 20 EMA)"
-    else:
-        # If not touching any EMA, score based on how close we are to key EMAs
-        closest_ema_index = np.argmin([abs(d) for d in ema_diffs])
-        closest_diff = ema_diffs[closest_ema_index]
-        
-        if closest_diff < 0:  # Below EMA
-            if closest_ema_index == 3:  # Closest to 200 EMA
-                return 85, "Near Goated Zone (Approaching 200 EMA)"
-            elif closest_ema_index == 2:  # Closest to 100 EMA
-                return 70, "Near Excellent Zone (Approaching 100 EMA)"
-            elif closest_ema_index == 1:  # Closest to 50 EMA
-                return 55, "Near Great Zone (Approaching 50 EMA)"
-            else:  # Closest to 20 EMA
-                return 40, "Near Good Zone (Approaching 20 EMA)"
-        else:  # Above EMA
-            if closest_ema_index == 3:  # Above 200 EMA
-                return 30, "⚠️ Caution Zone (Above 200 EMA)"
-            elif closest_ema_index == 2:  # Above 100 EMA
-                return 20, "⚠️ High Zone (Above 100 EMA)"
-            elif closest_ema_index == 1:  # Above 50 EMA
-                return 10, "⛔ Expensive Zone (Above 50 EMA)"
-            else:  # Above 20 EMA
-                return 0, "⛔ Very Expensive Zone (Above 20 EMA)"
-
-def calculate_signal(daily_df):
-    try:
-        if daily_df.empty:
-            raise ValueError("Empty DataFrame received")
-            
-        # Calculate all EMAs
-        ema_values = [
-            safe_float_conversion(daily_df['Close'].ewm(span=ema, adjust=False).mean().iloc[-1])
-            for ema in EMA_DAYS
-        ]
-        
-        last_close = safe_float_conversion(daily_df['Close'].iloc[-1])
-        volatility = safe_float_conversion(daily_df['Close'].pct_change().std() * 100)
-
-        # Calculate percentage differences from EMAs
-        ema_diffs = [
-            calculate_percentage_diff(last_close, ema)
-            for ema in ema_values
-        ]
-        
-        # Calculate zone score and classification
-        zone_score, zone_class = calculate_zone_score(ema_diffs)
+    idx = zone_index(np.asarray(ema_diffs, dtype=np.float64))
+    return _ZONE_SCORES[idx], [_ZONE_LABELS[i] for i in idx]
+
+def close_array(df):
+    """A ticker's closes as a float64 array with missing bars dropped (empty if none)"""
+    if df is None or 'Close' not in df:
+        return np.empty(0)
+    closes = df['Close'].to_numpy(dtype=np.float64)
+    return closes[~np.isnan(closes)]
+
+def stack_closes(closes):
+    """
+    Stack each ticker's close array into one contiguous float64 [days, tickers]
+    array, so the numeric pipeline runs on plain numpy instead of pandas objects.
+    Series are aligned on their latest bar so tickers trading on different
+    exchange calendars line up without gaps (shorter histories are NaN-padded
+    at the top).
+    """
+    length = max(len(c) for c in closes)
+    stacked = np.full((length, len(closes)), np.nan)
+    for i, c in enumerate(closes):
+        stacked[length - len(c):, i] = c
+    return stacked
+
+def backfill_leading(closes):
+    """
+    Replace the leading NaN padding of each column with that column's first
+    close. An EMA over a constant prefix stays at that value, so the final
+    EMA is unchanged while every column can share the same EMA weights.
+    """
+    first_valid = np.argmax(~np.isnan(closes), axis=0)
+    first_close = closes[first_valid, np.arange(closes.shape[1])]
+    return np.where(np.isnan(closes), first_close, closes)
+
+@lru_cache(maxsize=None)
+def ema_weights(n):
+    """
+    [spans, n] weights whose dot product with n closes gives each span's final
+    EMA (adjust=False) in closed form:
+    w = [(1-a)^(n-1), a(1-a)^(n-2), ..., a(1-a), a]
+    Cached per history length, which is the same for every ticker and run.
+    """
+    powers = np.arange(n - 1, -1, -1)
+    weights = EMA_ALPHAS[:, None] * EMA_DECAYS[:, None] ** powers
+    weights[:, 0] = EMA_DECAYS ** (n - 1)
+    weights.flags.writeable = False
+    return weights
+
+def ema_last(closes):
+    """
+    Final EMA values (adjust=False) for every column of a [days, tickers]
+    array and every span in EMA_DAYS, as a [tickers, spans] array.
+    One matrix product with the precomputed weights replaces the recurrence.
+    Only the last EMA_MAX_WINDOW rows are used, so the cost stays bounded if
+    HISTORY_PERIOD ever grows.
+    """
+    closes = backfill_leading(closes[-EMA_MAX_WINDOW:])
+    return closes.T @ ema_weights(len(closes)).T
+
+def analyze_closes(close_values):
+    """
+    All numeric work for a NaN-padded [days, tickers] close array in one place.
+    Returns (last_close, ema_values [tickers, spans], ema_diffs [tickers, spans],
+    volatility), all as arrays over tickers.
+    """
+    # Final EMAs for every ticker and span in one matrix product -> [tickers, spans]
+    # (non-finite EMAs become 0, which the percentage diff below maps to 0)
+    ema_matrix = np.nan_to_num(
+        ema_last(close_values), nan=0.0, posinf=0.0, neginf=0.0
+    )
+    last_close = close_values[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Daily return volatility per ticker (NaN padding drops out of nanstd).
+        # Tickers with fewer than 2 returns stay NaN, like pct_change().std(),
+        # without nanstd's degrees-of-freedom warning
+        returns = np.diff(close_values, axis=0) / close_values[:-1]
+        enough = np.count_nonzero(~np.isnan(returns), axis=0) >= 2
+        volatility = np.full(returns.shape[1], np.nan)
+        volatility[enough] = np.nanstd(returns[:, enough], axis=0, ddof=1) * 100
+
+    # Percentage differences from EMAs (0 where the EMA is 0, without dividing there)
+    ema_diffs = np.divide(
+        last_close[:, None] - ema_matrix, ema_matrix,
+        out=np.zeros_like(ema_matrix), where=ema_matrix != 0
+    )
+    ema_diffs *= 100
+    return last_close, ema_matrix, ema_diffs, volatility
 
-        # Buy signal conditions
-        buy_signal = (
-            zone_score >= 60 and  # At least "Good" zone
-            volatility <= VOLATILITY_THRESHOLD
+def nan_to_none(value):
+    """A float for JSON, with NaN as None since JSON has no NaN"""
+    value = float(value)
+    return None if np.isnan(value) else value
+
+@dataclass
+class ReportBatch:
+    """
+    Per-ticker report fields stored as parallel arrays (struct of arrays),
+    indexed by position in tickers. Rows with an error hold NaN/zero values.
+    """
+    tickers: list
+    last_close: np.ndarray   # [tickers]
+    ema_values: np.ndarray   # [tickers, spans]
+    ema_diffs: np.ndarray    # [tickers, spans]
+    volatility: np.ndarray   # [tickers]
+    zone_score: np.ndarray   # [tickers]
+    zone_class: list
+    buy_signal: np.ndarray   # [tickers]
+    errors: list
+
+    # Keys every to_entry snapshot has (not a dataclass field: no annotation)
+    SNAPSHOT_KEYS = frozenset((
+        'date', 'last_close', 'ema_values', 'ema_diffs', 'volatility',
+        'zone_score', 'zone_class', 'buy_signal'
+    ))
+
+    @classmethod
+    def empty(cls, tickers):
+        n = len(tickers)
+        return cls(
+            tickers=list(tickers),
+            last_close=np.full(n, np.nan),
+            ema_values=np.full((n, len(EMA_DAYS)), np.nan),
+            ema_diffs=np.full((n, len(EMA_DAYS)), np.nan),
+            volatility=np.full(n, np.nan),
+            zone_score=np.zeros(n, dtype=int),
+            zone_class=[''] * n,
+            buy_signal=np.zeros(n, dtype=bool),
+            errors=[None] * n
         )
 
+    @property
+    def valid(self):
+        """Boolean mask of rows that were analyzed successfully"""
+        return np.array([error is None for error in self.errors], dtype=bool)
+
+    def to_entry(self, i, date):
+        """
+        JSON-serializable snapshot of row i, stored in LAST_BUY_FILE.
+        NaN is stored as None (null), as orjson writes it, so a snapshot
+        compares equal to the same entry read back from the file.
+        """
         return {
-            'buy_signal': buy_signal,
-            'last_close': last_close,
-            'ema_values': ema_values,
-            'ema_diffs': ema_diffs,
-            'volatility': volatility,
-            'zone_score': zone_score,
-            'zone_class': zone_class,
-            'error': None
+            'date': date,
+            'last_close': nan_to_none(self.last_close[i]),
+            'ema_values': [nan_to_none(value) for value in self.ema_values[i]],
+            'ema_diffs': [nan_to_none(diff) for diff in self.ema_diffs[i]],
+            'volatility': nan_to_none(self.volatility[i]),
+            'zone_score': int(self.zone_score[i]),
+            'zone_class': self.zone_class[i],
+            'buy_signal': bool(self.buy_signal[i])
         }
+
+    @classmethod
+    def can_reuse(cls, entry, date):
+        """
+        True if entry is a complete to_entry snapshot taken on date, for the
+        current EMA_DAYS, that load_entry can read. Anything else (old or
+        hand-edited entries) is recomputed instead of reused.
+        """
+        if not isinstance(entry, dict) or entry.get('date') != date:
+            return False
+        if not cls.SNAPSHOT_KEYS <= entry.keys():
+            return False
+        for key in ('ema_values', 'ema_diffs'):
+            if not isinstance(entry[key], list) or len(entry[key]) != len(EMA_DAYS):
+                return False
+        if not isinstance(entry['zone_class'], str):
+            return False
+        try:
+            cls.empty([None]).load_entry(0, entry)
+        except Exception:
+            return False
+        return True
+
+    def load_entry(self, i, entry):
+        """Fill row i from a snapshot written by to_entry (None becomes NaN)"""
+        self.last_close[i] = np.asarray(entry['last_close'], dtype=np.float64)
+        self.ema_values[i] = np.asarray(entry['ema_values'], dtype=np.float64)
+        self.ema_diffs[i] = np.asarray(entry['ema_diffs'], dtype=np.float64)
+        self.volatility[i] = np.asarray(entry['volatility'], dtype=np.float64)
+        self.zone_score[i] = entry['zone_score']
+        self.zone_class[i] = entry['zone_class']
+        self.buy_signal[i] = entry['buy_signal']
+
+def calculate_signals(tickers, daily_data, cached=None):
+    """
+    Calculate signals for all tickers at once into a ReportBatch.
+    Tickers in cached (ticker -> snapshot from ReportBatch.to_entry) are
+    filled from the snapshot instead of being recomputed.
+    """
+    cached = cached or {}
+    batch = ReportBatch.empty(tickers)
+
+    # Pull the closes out of each frame once; everything after this is numpy
+    rows, closes = [], []
+    for i, ticker in enumerate(tickers):
+        if ticker in cached:
+            batch.load_entry(i, cached[ticker])
+            continue
+        close = close_array(daily_data.get(ticker))
+        if close.size == 0:
+            batch.errors[i] = 'Failed to fetch data'
+        else:
+            rows.append(i)
+            closes.append(close)
+    if not rows:
+        return batch
+
+    logging.info("Analyzing: %s", ', '.join(tickers[i] for i in rows))
+    try:
+        close_values = stack_closes(closes)
+
+        last_close, ema_matrix, ema_diffs, volatility = analyze_closes(close_values)
+
+        # Calculate zone scores and classifications
+        zone_scores, zone_classes = calculate_zone_scores(ema_diffs)
     except Exception as e:
-        logging.error(f"Error in calculate_signal: {str(e)}")
-        return {'error': str(e)}
+        logging.error("Error in calculate_signals: %s", e)
+        for i in rows:
+            batch.errors[i] = str(e)
+        return batch
+
+    batch.last_close[rows] = last_close
+    batch.ema_values[rows] = ema_matrix
+    batch.ema_diffs[rows] = ema_diffs
+    batch.volatility[rows] = volatility
+    batch.zone_score[rows] = zone_scores
+    for i, zone_class in zip(rows, zone_classes):
+        batch.zone_class[i] = zone_class
+
+    # Buy signal conditions: at least "Good" zone and calm enough
+    batch.buy_signal[rows] = (zone_scores >= 60) & (volatility <= VOLATILITY_THRESHOLD)
+    return batch
 
 def load_last_buy_dates():
     try:
         if not os.path.exists(LAST_BUY_FILE):
             return {}
-        with open(LAST_BUY_FILE, 'r') as f:
-            return json.load(f)
+        with open(LAST_BUY_FILE, 'rb') as f:
+            raw = f.read()
+        data = orjson.loads(raw) if orjson else json.loads(raw)
+        if not isinstance(data, dict):
+            raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+        return data
     except Exception as e:
-        logging.error(f"Error loading last buy dates: {str(e)}")
+        logging.error("Error loading last buy dates: %s", e)
         return {}
 
 def save_last_buy_dates(data):
     try:
-        with open(LAST_BUY_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
+        if orjson:
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(data, indent=2).encode('utf-8')
+        # Write to a temp file and swap it in so a crash never leaves a half-written file
+        tmp_file = LAST_BUY_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_file, LAST_BUY_FILE)
     except Exception as e:
-        logging.error(f"Error saving last buy dates: {str(e)}")
+        logging.error("Error saving last buy dates: %s", e)
 
-def send_email(subject, html_body):
-    try:
+class SmtpSender:
+    """
+    Keeps one authenticated SMTP connection open so several emails can be sent
+    with a single TLS handshake and login:
+
+        with SmtpSender() as sender:
+            sender.send(subject, html_body)
+    """
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT):
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def __enter__(self):
+        self.server = smtplib.SMTP_SSL(self.host, self.port)
+        try:
+            self.server.ehlo()
+            self.server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        except Exception:
+            # __exit__ does not run when __enter__ fails, so close the socket here
+            self.server.close()
+            raise
+        return self
+
+    def send(self, subject, html_body, receivers=None):
         msg = MIMEMultipart()
         msg['From'] = EMAIL_SENDER
-        msg["To"] = ", ".join(EMAIL_RECEIVERS)
+        msg["To"] = ", ".join(receivers or EMAIL_RECEIVERS)
         msg['Subject'] = subject
-        msg.attach(MIMEText(html_body, 'html'))
+        msg.attach(MIMEText(html_body, 'html', HTML_CHARSET))
+        self.server.send_message(msg)
 
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.send_message(msg)
-        logging.info("Email sent successfully")
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.server.quit()
+        except smtplib.SMTPException:
+            self.server.close()
+
+def send_emails(messages):
+    """
+    Send (subject, html_body, receivers) tuples over one SMTP session.
+    receivers may be None to use EMAIL_RECEIVERS. A failed message is logged
+    and skipped so the rest still go out.
+    """
+    try:
+        with SmtpSender() as sender:
+            for subject, html_body, receivers in messages:
+                try:
+                    sender.send(subject, html_body, receivers)
+                    logging.info("Email sent successfully: %s", subject)
+                except smtplib.SMTPException as e:
+                    logging.error("Error sending email '%s': %s", subject, e)
     except Exception as e:
-        logging.error(f"Error sending email: {str(e)}")
+        logging.error("Error sending email: %s", e)
 
-def is_last_day_of_month():
-    today = datetime.now()
-    next_day = today + timedelta(days=1)
-    return today.month != next_day.month
+def send_email(subject, html_body):
+    send_emails([(subject, html_body, None)])
 
-def generate_html(reports, force_buy=False):
-    today = datetime.now()
-    html = f"""
+def is_last_day_of_month(today):
+    return calendar.monthrange(today.year, today.month)[1] == today.day
+
+# Static document head and stylesheet, shared by every report
+_HTML_HEAD = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -213,272 +616,282 @@ def generate_html(reports, force_buy=False):
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>Aman's ETF Newsletter</title>
         <style>
-            body {{
+            body {
                 font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
                 background-color: #f8fafc;
                 color: #1e293b;
                 line-height: 1.6;
                 padding: 20px;
                 max-width: 100%;
-            }}
-            .container {{
+            }
+            .container {
                 max-width: 1000px;
                 margin: 0 auto;
                 background: white;
                 border-radius: 12px;
                 overflow: hidden;
                 box-shadow: 0 4px 12px rgba(0,0,0,0.05);
-            }}
-            .header {{
+            }
+            .header {
                 background: linear-gradient(135deg, #4f46e5 0%, #7c3aed 100%);
                 color: white;
                 text-align: center;
                 padding: 25px 20px;
                 border-radius: 12px 12px 0 0;
-            }}
-            .header h1 {{
+            }
+            .header h1 {
                 margin: 0;
                 font-size: 1.8rem;
-            }}
-            .header p {{
+            }
+            .header p {
                 margin: 5px 0 0;
                 opacity: 0.9;
-            }}
-            .date-badge {{
+            }
+            .date-badge {
                 display: inline-block;
                 background: rgba(255,255,255,0.15);
                 padding: 5px 12px;
                 border-radius: 20px;
                 margin-top: 12px;
                 font-size: 0.9rem;
-            }}
-            .force-buy-notice {{
+            }
+            .force-buy-notice {
                 background: #fffbeb;
                 padding: 15px;
                 text-align: center;
                 border-bottom: 1px solid #fde68a;
-            }}
-            .cards-container {{
+            }
+            .cards-container {
                 display: grid;
                 grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
                 gap: 20px;
                 padding: 25px;
-            }}
-            .card {{
+            }
+            .card {
                 background: white;
                 border-radius: 12px;
                 overflow: hidden;
                 box-shadow: 0 4px 6px rgba(0,0,0,0.05);
                 border-top: 4px solid;
-            }}
-            .card-header {{
+            }
+            .card-header {
                 padding: 15px 20px;
                 border-bottom: 1px solid #e2e8f0;
                 display: flex;
                 justify-content: space-between;
                 align-items: center;
-            }}
-            .card-title {{
+            }
+            .card-title {
                 font-weight: 600;
                 font-size: 1.1rem;
-            }}
-            .zone-class {{
+            }
+            .zone-class {
                 font-weight: 600;
                 padding: 4px 10px;
                 border-radius: 20px;
                 font-size: 0.85rem;
-            }}
-            .price-container {{
+            }
+            .price-container {
                 display: flex;
                 padding: 15px 20px;
                 border-bottom: 1px solid #e2e8f0;
-            }}
-            .price-box {{
+            }
+            .price-box {
                 flex: 1;
-            }}
-            .price-label {{
+            }
+            .price-label {
                 font-size: 0.9rem;
                 color: #64748b;
                 margin-bottom: 5px;
-            }}
-            .price-value {{
+            }
+            .price-value {
                 font-weight: 700;
                 font-size: 1.4rem;
-            }}
-            .ma-table {{
+            }
+            .ma-table {
                 width: 100%;
                 border-collapse: collapse;
                 font-size: 0.9rem;
-            }}
-            .ma-table th, .ma-table td {{
+            }
+            .ma-table th, .ma-table td {
                 padding: 12px 15px;
                 text-align: left;
                 border-bottom: 1px solid #e2e8f0;
-            }}
-            .ma-table th {{
+            }
+            .ma-table th {
                 font-weight: 600;
                 color: #64748b;
                 background-color: #f8fafc;
-            }}
-            .diff-down {{
+            }
+            .diff-down {
                 color: #10b981;
                 font-weight: 600;
-            }}
-            .diff-up {{
+            }
+            .diff-up {
                 color: #ef4444;
                 font-weight: 600;
-            }}
-            .recommendation {{
+            }
+            .recommendation {
                 padding: 15px;
                 text-align: center;
                 font-weight: 700;
                 border-top: 1px solid #e2e8f0;
-            }}
-            .buy {{
+            }
+            .buy {
                 background: #d1fae5;
                 color: #065f46;
-            }}
-            .hold {{
+            }
+            .hold {
                 background: #fef3c7;
                 color: #92400e;
-            }}
-            .avoid {{
+            }
+            .avoid {
                 background: #fee2e2;
                 color: #991b1b;
-            }}
-            .footer {{
+            }
+            .footer {
                 background: #f1f5f9;
                 padding: 25px;
                 text-align: center;
                 border-top: 1px solid #e2e8f0;
-            }}
-            .legend {{
+            }
+            .legend {
                 display: flex;
                 flex-wrap: wrap;
                 justify-content: center;
                 gap: 15px;
                 margin-bottom: 20px;
-            }}
-            .legend-item {{
+            }
+            .legend-item {
                 display: flex;
                 align-items: center;
                 gap: 8px;
                 font-size: 0.85rem;
-            }}
-            .legend-color {{
+            }
+            .legend-color {
                 width: 12px;
                 height: 12px;
                 border-radius: 50%;
-            }}
-            .disclaimer {{
+            }
+            .disclaimer {
                 font-size: 0.8rem;
                 color: #64748b;
                 line-height: 1.5;
                 max-width: 700px;
                 margin: 0 auto;
-            }}
-            .error-card {{
+            }
+            .error-card {
                 background: #fee2e2;
                 border-radius: 8px;
                 padding: 20px;
                 color: #991b1b;
                 font-weight: 500;
-            }}
+            }
             
             /* Responsive adjustments */
-            @media (max-width: 768px) {{
-                .cards-container {{
+            @media (max-width: 768px) {
+                .cards-container {
                     grid-template-columns: 1fr;
                     padding: 15px;
-                }}
-                .header {{
+                }
+                .header {
                     padding: 20px 15px;
-                }}
-                .header h1 {{
+                }
+                .header h1 {
                     font-size: 1.5rem;
-                }}
-            }}
+                }
+            }
         </style>
     </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>Aman's ETF Newsletter</h1>
-                <p>EMA Touch Strategy</p>
-                <div class="date-badge">{today.strftime('%d %B %Y')}</div>
-            </div>
-            
-            {f'<div class="force-buy-notice">📅 Monthly Reminder: Today is the last trading day of the month. Recommended to accumulate if not done already.</div>' if force_buy else ''}
-            
-            <div class="cards-container">
+"""
+
+def minify_head(head):
     """
-    
-    for r in reports:
-        if r.get('error'):
-            html += f"""
+    Strip CSS comments and the indentation whitespace from the static head.
+    Kept readable above and minified once at import; roughly halves its size in every email.
+    """
+    head = re.sub(r'/\*.*?\*/', '', head, flags=re.S)
+    head = ''.join(line.strip() for line in head.splitlines())
+    head = re.sub(r'\s*([{};,])\s*', r'\1', head)
+    head = re.sub(r':\s+', ':', head)
+    return head.replace(';}', '}')
+
+_HTML_HEAD = minify_head(_HTML_HEAD)
+
+# Card colours by minimum zone score, checked in order
+_ZONE_COLORS = [
+    (90, "#0ea5e9"),
+    (75, "#8b5cf6"),
+    (60, "#f59e0b"),
+    (30, "#f97316"),
+    (float('-inf'), "#ef4444"),
+]
+_GOATED_COLOR = "#10b981"
+
+@lru_cache(maxsize=None)
+def card_style(zone_score, zone_class, accumulate):
+    """
+    Display fields for a card: (zone_color, zone_label, rec_class, recommendation).
+    They depend only on the zone and whether to accumulate, so each combination
+    is worked out once and reused by every card in that zone.
+    """
+    # Determine card colour based on zone score (Goated price is a special case)
+    if "Goated" in zone_class:
+        zone_color = _GOATED_COLOR
+    else:
+        zone_color = next(color for threshold, color in _ZONE_COLORS if zone_score >= threshold)
+
+    # Determine recommendation
+    if accumulate:
+        rec_class = "buy"
+        if "Goated" in zone_class:
+            recommendation = "🐐 GOATED PRICE - STRONG ACCUMULATE"
+        elif "Excellent" in zone_class:
+            recommendation = "⭐ EXCELLENT PRICE - ACCUMULATE"
+        elif "Great" in zone_class:
+            recommendation = "👍 GREAT PRICE - ACCUMULATE"
+        else:
+            recommendation = "🔼 GOOD PRICE - ACCUMULATE"
+    elif zone_score >= 60:
+        rec_class = "hold"
+        recommendation = "⏳ WAIT - Approaching good price"
+    else:
+        rec_class = "avoid"
+        recommendation = "⛔ AVOID - Price too high"
+
+    return zone_color, zone_class.split('(')[0].strip(), rec_class, recommendation
+
+# Per-report HTML fragments, formatted with str.format (bound once at import)
+_ERROR_CARD_TEMPLATE = """
                 <div class="error-card">
-                    <strong>Error analyzing {r['ticker']}:</strong> {r['error']}
+                    <strong>Error analyzing {ticker}:</strong> {error}
                 </div>
-            """
-            continue
-            
-        # Determine card class based on zone score
-        if r['zone_score'] >= 90:
-            card_class = "excellent"
-            zone_color = "#0ea5e9"
-        elif r['zone_score'] >= 75:
-            card_class = "great"
-            zone_color = "#8b5cf6"
-        elif r['zone_score'] >= 60:
-            card_class = "good"
-            zone_color = "#f59e0b"
-        elif r['zone_score'] >= 30:
-            card_class = "caution"
-            zone_color = "#f97316"
-        else:
-            card_class = "avoid"
-            zone_color = "#ef4444"
-        
-        # Special case for Goated price
-        if "Goated" in r['zone_class']:
-            card_class = "goated"
-            zone_color = "#10b981"
-        
-        # Determine recommendation
-        if force_buy or r['buy_signal']:
-            rec_class = "buy"
-            if "Goated" in r['zone_class']:
-                recommendation = "🐐 GOATED PRICE - STRONG ACCUMULATE"
-            elif "Excellent" in r['zone_class']:
-                recommendation = "⭐ EXCELLENT PRICE - ACCUMULATE"
-            elif "Great" in r['zone_class']:
-                recommendation = "👍 GREAT PRICE - ACCUMULATE"
-            else:
-                recommendation = "🔼 GOOD PRICE - ACCUMULATE"
-        elif r['zone_score'] >= 60:
-            rec_class = "hold"
-            recommendation = "⏳ WAIT - Approaching good price"
-        else:
-            rec_class = "avoid"
-            recommendation = "⛔ AVOID - Price too high"
-        
-        html += f"""
+            """.format
+
+_EMA_ROW_TEMPLATE = """
+                        <tr>
+                            <td>{span} EMA</td>
+                            <td>₹{value:.2f}</td>
+                            <td class="{diff_class}">{diff:+.1f}%</td>
+                        </tr>""".format
+
+_CARD_TEMPLATE = """
                 <div class="card" style="border-top-color: {zone_color}">
                     <div class="card-header">
-                        <div class="card-title">{r['ticker']}</div>
+                        <div class="card-title">{ticker}</div>
                         <div class="zone-class" style="background: {zone_color}22; color: {zone_color}">
-                            {r['zone_class'].split('(')[0].strip()}
+                            {zone_label}
                         </div>
                     </div>
                     
                     <div class="price-container">
                         <div class="price-box">
                             <div class="price-label">CURRENT PRICE</div>
-                            <div class="price-value">₹{r['last_close']:.2f}</div>
+                            <div class="price-value">₹{last_close:.2f}</div>
                         </div>
                         <div class="price-box">
                             <div class="price-label">VOLATILITY</div>
-                            <div class="price-value">{r['volatility']:.1f}%</div>
+                            <div class="price-value">{volatility:.1f}%</div>
                         </div>
                     </div>
                     
@@ -487,36 +900,61 @@ def generate_html(reports, force_buy=False):
                             <th>EMA</th>
                             <th>Value</th>
                             <th>Difference</th>
-                        </tr>
-                        <tr>
-                            <td>20 EMA</td>
-                            <td>₹{r['ema_values'][0]:.2f}</td>
-                            <td class="{'diff-down' if r['ema_diffs'][0] < 0 else 'diff-up'}">{r['ema_diffs'][0]:+.1f}%</td>
-                        </tr>
-                        <tr>
-                            <td>50 EMA</td>
-                            <td>₹{r['ema_values'][1]:.2f}</td>
-                            <td class="{'diff-down' if r['ema_diffs'][1] < 0 else 'diff-up'}">{r['ema_diffs'][1]:+.1f}%</td>
-                        </tr>
-                        <tr>
-                            <td>100 EMA</td>
-                            <td>₹{r['ema_values'][2]:.2f}</td>
-                            <td class="{'diff-down' if r['ema_diffs'][2] < 0 else 'diff-up'}">{r['ema_diffs'][2]:+.1f}%</td>
-                        </tr>
-                        <tr>
-                            <td>200 EMA</td>
-                            <td>₹{r['ema_values'][3]:.2f}</td>
-                            <td class="{'diff-down' if r['ema_diffs'][3] < 0 else 'diff-up'}">{r['ema_diffs'][3]:+.1f}%</td>
-                        </tr>
+                        </tr>{ema_rows}
                     </table>
                     
                     <div class="recommendation {rec_class}">
                         {recommendation}
                     </div>
                 </div>
-        """
+        """.format
+
+def generate_html(batch, today, force_buy=False):
+    html_parts = [_HTML_HEAD]
+    html_parts.append(f"""
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>Aman's ETF Newsletter</h1>
+                <p>EMA Touch Strategy</p>
+                <div class="date-badge">{today.strftime('%d %B %Y')}</div>
+            </div>
+            
+            {f'<div class="force-buy-notice">📅 Monthly Reminder: Today is the last trading day of the month. Recommended to accumulate if not done already.</div>' if force_buy else ''}
+            
+            <div class="cards-container">
+    """)
     
-    html += f"""
+    for i, ticker in enumerate(batch.tickers):
+        error = batch.errors[i]
+        if error:
+            html_parts.append(_ERROR_CARD_TEMPLATE(ticker=ticker, error=error))
+            continue
+
+        zone_color, zone_label, rec_class, recommendation = card_style(
+            int(batch.zone_score[i]), batch.zone_class[i], bool(force_buy or batch.buy_signal[i])
+        )
+
+        ema_rows = ''.join(
+            _EMA_ROW_TEMPLATE(
+                span=span, value=value, diff=diff,
+                diff_class='diff-down' if diff < 0 else 'diff-up'
+            )
+            for span, value, diff in zip(EMA_DAYS, batch.ema_values[i], batch.ema_diffs[i])
+        )
+        
+        html_parts.append(_CARD_TEMPLATE(
+            ticker=ticker,
+            zone_color=zone_color,
+            zone_label=zone_label,
+            last_close=batch.last_close[i],
+            volatility=batch.volatility[i],
+            ema_rows=ema_rows,
+            rec_class=rec_class,
+            recommendation=recommendation
+        ))
+    
+    html_parts.append(f"""
             </div>
             
             <div class="footer">
@@ -558,60 +996,54 @@ def generate_html(reports, force_buy=False):
         </div>
     </body>
     </html>
-    """
-    return html
+    """)
+    return ''.join(html_parts)
 
-def main():
+def main(force=False):
     logging.info("=" * 60)
     logging.info("ETF EMA Touch Accumulation Report")
     logging.info("=" * 60)
 
     last_buys = load_last_buy_dates()
     today = datetime.now()
+    today_str = today.strftime('%Y-%m-%d')
     current_month = today.strftime('%Y-%m')
-    reports = []
-    force_buy = is_last_day_of_month()
+    force_buy = is_last_day_of_month(today)
 
-    for ticker in TICKERS:
-        logging.info(f"Analyzing: {ticker}")
-        
-        # Fetch daily data
-        daily = fetch_data(ticker, '6mo', '1d')
-
-        if daily.empty:
-            reports.append({
-                'ticker': ticker,
-                'error': 'Failed to fetch data',
-                'buy_signal': False
-            })
-            continue
+    # Reuse tickers already analyzed today (cron retries, re-sends) unless forced.
+    # Entries that are not a usable snapshot just put the ticker back in pending.
+    cached = {} if force else {
+        ticker: entry for ticker, entry in last_buys.items()
+        if ticker in TICKERS and ReportBatch.can_reuse(entry, today_str)
+    }
+    if cached:
+        logging.info("Reusing today's analysis for: %s", ', '.join(cached))
 
-        result = calculate_signal(daily)
-        if result.get('error'):
-            reports.append({
-                'ticker': ticker,
-                'error': result['error'],
-                'buy_signal': False
-            })
-            continue
+    # Fetch daily data for every remaining ticker in a single request
+    pending = [ticker for ticker in TICKERS if ticker not in cached]
+    daily_data = fetch_all(pending, HISTORY_PERIOD, '1d') if pending else {}
+    batch = calculate_signals(TICKERS, daily_data, cached)
 
-        reports.append({
-            'ticker': ticker,
-            'last_close': result['last_close'],
-            'ema_values': result['ema_values'],
-            'ema_diffs': result['ema_diffs'],
-            'volatility': result['volatility'],
-            'zone_score': result['zone_score'],
-            'zone_class': result['zone_class'],
-            'buy_signal': result['buy_signal'],
-            'error': None
-        })
+    # Merge today's snapshot into each ticker's entry, keeping any other fields
+    # it already has, and only rewrite the file when an entry actually changed
+    dirty = False
+    for i, ticker in enumerate(batch.tickers):
+        if batch.errors[i] is None and ticker not in cached:
+            old = last_buys.get(ticker)
+            entry = batch.to_entry(i, today_str)
+            if isinstance(old, dict):
+                entry = {**old, **entry}
+            if old != entry:
+                last_buys[ticker] = entry
+                dirty = True
+    if dirty:
+        save_last_buy_dates(last_buys)
 
     subject = f"📊 Aman's ETF Report - {today.strftime('%d %b %Y')}"
     if force_buy:
         subject = f"🚨 Monthly Reminder: {subject}"
-    elif any(r.get('buy_signal', False) for r in reports):
-        best_zone = max(r['zone_score'] for r in reports if not r.get('error'))
+    elif batch.buy_signal.any():
+        best_zone = batch.zone_score[batch.valid].max()
         if best_zone >= 90:
             subject = f"🐐 Goated Price Alert: {subject}"
         elif best_zone >= 75:
@@ -619,8 +1051,16 @@ def main():
         else:
             subject = f"✅ Good Accumulation: {subject}"
     
-    html = generate_html(reports, force_buy)
+    html = generate_html(batch, today, force_buy)
     send_email(subject, html)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send the daily ETF EMA accumulation report")
+    parser.add_argument(
+        '--force', action='store_true',
+        help="recompute every ticker even if it was already analyzed today"
+    )
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    main()
+    main(force=parse_args().force)